@@ -0,0 +1,353 @@
+"""Calculs de l'analyse du sous-groupe, sans interface.
+
+Fonctions pures (chargement, préparation, indicateurs, graphiques, export)
+appelées par app.py. Les étapes coûteuses sont mises en cache avec
+st.cache_data : un rerun Streamlit ne recalcule que les étapes dont les
+entrées ont changé.
+"""
+import io
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+import streamlit as st
+
+
+# --------------------------------------------------------
+# CHARGEMENT / PRÉPARATION
+# --------------------------------------------------------
+
+@st.cache_data(show_spinner="Lecture du fichier Excel...", max_entries=4)
+def load_excel(file_bytes: bytes) -> pd.DataFrame:
+    """Lit la 1ère feuille du fichier, mis en cache sur le contenu du fichier."""
+    return pd.read_excel(io.BytesIO(file_bytes))
+
+
+def period_dates(n_periods: int) -> pd.DatetimeIndex:
+    """Date de chaque colonne de mois (en partant de janv-2024).
+
+    On suppose que les colonnes sont déjà dans l'ordre chronologique.
+    """
+    return pd.date_range("2024-01-01", periods=n_periods, freq="MS")
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def prepare_long(_df_raw: pd.DataFrame, file_hash: str, id_cols: list, period_cols: list) -> pd.DataFrame:
+    """Passe le tableau récap au format long (une ligne par salarié et par mois).
+
+    Le cache est indexé sur l'empreinte du fichier (`file_hash`) et non sur `_df_raw` :
+    au-delà de 50 000 lignes, Streamlit ne hache qu'un échantillon du DataFrame.
+    """
+    dates = period_dates(len(period_cols))
+
+    # Passage au format long
+    df_long = _df_raw.melt(
+        id_vars=id_cols,
+        value_vars=period_cols,
+        var_name="Periode_label",
+        value_name="Cout_global",
+    )
+
+    # melt empile les colonnes de mois l'une après l'autre : la ligne i correspond
+    # au mois i // len(_df_raw), ce qui évite toute recherche dans un dictionnaire.
+    # Le libellé texte du mois n'est pas conservé (seulement sa position PerIdx),
+    # il est reconstruit à l'affichage pour les quelques lignes qui en ont besoin.
+    month_pos = np.repeat(np.arange(len(period_cols), dtype=np.int16), len(_df_raw))
+    df_long = df_long.drop(columns="Periode_label")
+    df_long["PerIdx"] = month_pos
+    df_long["Date"] = dates[month_pos]
+    df_long["Year"] = df_long["Date"].dt.year
+
+    # On garde uniquement les lignes avec un coût renseigné
+    df_long = df_long.dropna(subset=["Cout_global"])
+
+    # Cout_global reste en float64 : les sommes annuelles et les moyennes sont
+    # affichées et exportées au centime. L'année tient en int16.
+    df_long["Year"] = df_long["Year"].astype("int16")
+
+    # Identifiants en catégories : les groupby travaillent sur des codes entiers
+    df_long["Salarie"] = df_long["Salarie"].astype("category")
+    df_long["Sous_groupe"] = df_long["Sous_groupe"].astype("category")
+    return df_long
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def extract_group(_df_long: pd.DataFrame, file_hash: str, group: str) -> pd.DataFrame:
+    """Extrait les lignes du sous-groupe et ajoute l'index temporel et les anomalies.
+
+    Comme pour `prepare_long`, le cache est indexé sur (`file_hash`, `group`) : les
+    DataFrames préfixés par `_` ne sont pas hachés par Streamlit.
+    """
+    # Sous_groupe est catégoriel : le masque compare des codes entiers. Pas de .copy(),
+    # les colonnes sont ajoutées par assign(), qui renvoie un nouveau DataFrame.
+    df_group = _df_long[_df_long["Sous_groupe"] == group]
+
+    # Tri unique par (salarié, mois), réutilisé par toutes les étapes suivantes (groupby sort=False)
+    df_group = df_group.sort_values(["Salarie", "Date"], kind="mergesort")
+
+    # Index temporel global : rang du mois parmi les mois présents (recherche binaire)
+    # unique() est une table de hachage (O(N)) : seules la vingtaine de dates distinctes sont triées
+    dates_sorted = np.sort(df_group["Date"].unique())
+
+    return df_group.assign(
+        idx=np.searchsorted(dates_sorted, df_group["Date"].to_numpy()).astype(np.int16),
+        # Anomalies (valeurs très faibles ou négatives) : "< 500" couvre aussi "≤ 0"
+        Anomalie=df_group["Cout_global"].to_numpy() < 500,
+    )
+
+
+# --------------------------------------------------------
+# LOGIQUE ARRÊTS / ENTRÉES / SORTIES
+# --------------------------------------------------------
+
+def parcours_kernel(codes, idx, cout, seuil_absence):
+    """Calcule en une passe, sur des tableaux triés par (salarié, mois), le premier
+    et le dernier mois, le nombre de mois faibles et le plus long bloc de mois faibles."""
+    new_sal = np.r_[True, codes[1:] != codes[:-1]]
+    last_sal = np.r_[new_sal[1:], True]
+    sal_start = np.flatnonzero(new_sal)
+
+    first_idx = idx[new_sal]
+    last_idx = idx[last_sal]
+
+    faible = (cout <= seuil_absence) | np.isnan(cout)
+    nb_faibles = np.add.reduceat(faible.astype(np.int64), sal_start)
+
+    # Plus long bloc (run-length encoding) : un bloc s'arrête à chaque
+    # changement de valeur de `faible` ou de salarié.
+    starts = np.flatnonzero(faible & (new_sal | ~np.r_[False, faible[:-1]]))
+    ends = np.flatnonzero(faible & (last_sal | ~np.r_[faible[1:], False]))
+    longest = np.zeros(len(sal_start), dtype=np.int64)
+    np.maximum.at(longest, np.cumsum(new_sal)[starts] - 1, ends - starts + 1)
+
+    return first_idx, last_idx, nb_faibles, longest
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def compute_parcours(_df_group: pd.DataFrame, file_hash: str, group: str, seuil_absence: int) -> pd.DataFrame:
+    """Calcule la logique entrée/sortie/arrêts de chaque salarié du sous-groupe.
+
+    Seule étape dépendant du seuil : c'est la seule recalculée quand le slider bouge.
+    """
+    global_first_idx = 0
+    global_last_idx = int(_df_group["idx"].max())
+
+    # Codes entiers par salarié ; _df_group est déjà trié par (salarié, mois)
+    codes, uniques = pd.factorize(_df_group["Salarie"], sort=True)
+
+    # Lignes sans salarié (code -1) écartées, comme le ferait un groupby("Salarie")
+    has_salarie = codes >= 0
+
+    first_idx, last_idx, nb_faibles, longest = parcours_kernel(
+        codes[has_salarie],
+        _df_group["idx"].to_numpy()[has_salarie],
+        _df_group["Cout_global"].to_numpy()[has_salarie],
+        seuil_absence,
+    )
+
+    return pd.DataFrame({
+        "Salarie": uniques,
+        "entree_en_cours": first_idx > global_first_idx,
+        "sortie_en_cours": last_idx < global_last_idx,
+        "nb_mois_faibles": nb_faibles,
+        "plus_long_arret": longest,
+    })
+
+
+# --------------------------------------------------------
+# INDICATEURS PAR SALARIÉ
+# --------------------------------------------------------
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def compute_resume_base(_df_group: pd.DataFrame, file_hash: str, group: str) -> pd.DataFrame:
+    """Indicateurs par salarié indépendants du seuil (moyennes, variations, volatilité, anomalies)."""
+    # Moyenne annuelle par salarié, 2024 / 2025 côte à côte
+    by_year = (
+        _df_group
+        .groupby(["Salarie", "Year"], observed=True, sort=False)["Cout_global"]
+        .mean()
+        .unstack("Year")
+    )
+
+    # Sous-groupe, volatilité (écart-type) et nombre d'anomalies en une seule agrégation
+    aggs = _df_group.groupby("Salarie", observed=True, sort=False).agg(
+        Sous_groupe=("Sous_groupe", "first"),
+        ecart_type=("Cout_global", "std"),
+        nb_anomalies=("Anomalie", "sum"),
+    )
+
+    # Concaténation alignée sur l'index Salarie, sans merge
+    resume = pd.concat([aggs, by_year], axis=1).rename_axis("Salarie").reset_index()
+    resume["nb_anomalies"] = resume["nb_anomalies"].astype(int)
+
+    # Renommage plus lisible
+    col_2024 = 2024 if 2024 in resume.columns else None
+    col_2025 = 2025 if 2025 in resume.columns else None
+
+    if col_2024 is not None:
+        resume["moy_2024"] = resume[col_2024]
+    else:
+        resume["moy_2024"] = pd.NA
+
+    if col_2025 is not None:
+        resume["moy_2025"] = resume[col_2025]
+    else:
+        resume["moy_2025"] = pd.NA
+
+    # Variation absolue / relative
+    resume["var_abs"] = resume["moy_2025"] - resume["moy_2024"]
+    resume["var_rel_%"] = resume["var_abs"] / resume["moy_2024"] * 100
+
+    # Volatilité et anomalies en fin de tableau
+    stats_cols = ["ecart_type", "nb_anomalies"]
+    return resume[[c for c in resume.columns if c not in stats_cols] + stats_cols]
+
+
+def monthly_totals(df_group: pd.DataFrame, dates: pd.DatetimeIndex) -> pd.DataFrame:
+    """Coût global par mois du sous-groupe (mois sans aucune ligne exclus)."""
+    # Somme par mois via bincount sur la position du mois (PerIdx), sans hachage des dates
+    per_idx = df_group["PerIdx"].to_numpy()
+    month_sums = np.bincount(per_idx, weights=df_group["Cout_global"].to_numpy(), minlength=len(dates))
+    month_present = np.bincount(per_idx, minlength=len(dates)) > 0
+    return pd.DataFrame({
+        "Date": dates[month_present],
+        "Cout_global": month_sums[month_present],
+    })
+
+
+# --------------------------------------------------------
+# GRAPHIQUES
+# --------------------------------------------------------
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_total_line(agg_month: pd.DataFrame, group: str) -> go.Figure:
+    """Courbe du coût global mensuel du sous-groupe."""
+    fig_tot = px.line(
+        agg_month,
+        x="Date",
+        y="Cout_global",
+        markers=True,
+        title=f"Coût global mensuel du sous-groupe « {group} »",
+    )
+    fig_tot.update_layout(
+        xaxis_title="Mois",
+        yaxis_title="Coût global (€)",
+        xaxis_tickformat="%m/%Y",
+    )
+    return fig_tot
+
+
+TOP_HOVER_COLS = [
+    "moy_2024",
+    "moy_2025",
+    "var_rel_%",
+    "ecart_type",
+    "nb_anomalies",
+    "entree_en_cours",
+    "sortie_en_cours",
+    "plus_long_arret",
+]
+
+# Info-bulle : l'ordre des customdata suit TOP_HOVER_COLS
+TOP_HOVERTEMPLATE = (
+    "<b>%{x}</b><br>"
+    "var_abs = %{y:,.0f} €<br>"
+    "moy_2024 = %{customdata[0]:,.0f} €<br>"
+    "moy_2025 = %{customdata[1]:,.0f} €<br>"
+    "var_rel_% = %{customdata[2]:.1f} %<br>"
+    "ecart_type = %{customdata[3]:,.0f} €<br>"
+    "nb_anomalies = %{customdata[4]}<br>"
+    "entree_en_cours = %{customdata[5]}<br>"
+    "sortie_en_cours = %{customdata[6]}<br>"
+    "plus_long_arret = %{customdata[7]} mois"
+    "<extra></extra>"
+)
+
+
+def top_bar_figure(top: pd.DataFrame, title: str) -> go.Figure:
+    """Graphique en barres de la variation absolue, construit directement avec go.Bar."""
+    fig = go.Figure(
+        go.Bar(
+            x=top["Salarie"].to_numpy(),
+            y=top["var_abs"].to_numpy(),
+            customdata=top[TOP_HOVER_COLS].to_numpy(dtype=object),
+            hovertemplate=TOP_HOVERTEMPLATE,
+        )
+    )
+    fig.update_layout(title=title, xaxis_title="", yaxis_title="Variation absolue (€)")
+    fig.update_xaxes(tickangle=45)
+    return fig
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_top_figures(resume_sorted: pd.DataFrame, top_n: int):
+    """Construit les deux graphiques en barres (top hausses / top baisses)."""
+    # Les variations non calculables (rangées en dernier par le tri) sont écartées des deux classements
+    valid = resume_sorted[resume_sorted["var_abs"].notna()]
+    # Top hausses
+    top_up = valid.head(top_n)
+    # Top baisses : fin du tableau déjà trié, lue à l'envers
+    top_down = valid.tail(top_n).iloc[::-1]
+
+    fig_up = top_bar_figure(top_up, "Top hausses de coût moyen annuel")
+    fig_down = top_bar_figure(top_down, "Top baisses de coût moyen annuel")
+    return fig_up, fig_down
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_scatter(df_scatter: pd.DataFrame) -> go.Figure:
+    """Nuage niveau moyen 2024 vs volatilité, variation en taille et en couleur."""
+    fig_scatter = px.scatter(
+        df_scatter.assign(size_var=df_scatter["var_abs"].abs()),
+        x="moy_2024",
+        y="ecart_type",
+        size="size_var",
+        color="var_abs",
+        hover_data=[
+            "Salarie",
+            "moy_2025",
+            "var_rel_%",
+            "nb_anomalies",
+            "entree_en_cours",
+            "sortie_en_cours",
+            "plus_long_arret",
+            "nb_mois_faibles",
+        ],
+        title="Niveau moyen 2024 vs volatilité (variation en taille/couleur, arrêts en info-bulle)",
+        # Un point par salarié : rendu WebGL (Scattergl), bien plus léger côté navigateur que le SVG
+        render_mode="webgl",
+    )
+    fig_scatter.update_layout(
+        xaxis_title="Coût moyen 2024 (€)",
+        yaxis_title="Écart-type du coût mensuel (€)",
+    )
+    return fig_scatter
+
+
+# --------------------------------------------------------
+# EXPORT
+# --------------------------------------------------------
+
+@st.cache_data(show_spinner="Génération du fichier Excel...", max_entries=4)
+def build_export(
+    _resume_sorted: pd.DataFrame,
+    _df_group: pd.DataFrame,
+    _period_labels: np.ndarray,
+    file_hash: str,
+    group: str,
+    seuil_absence: int,
+) -> bytes:
+    """Écrit le récapitulatif et le détail long dans un classeur Excel.
+
+    Comme les étapes d'analyse, mis en cache sur (`file_hash`, `group`, `seuil_absence`).
+    """
+    detail = _df_group.assign(
+        Periode_label=_period_labels[_df_group["PerIdx"].to_numpy()],
+    ).drop(columns="PerIdx")
+
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+        _resume_sorted.to_excel(writer, index=False, sheet_name="Resume_sous_groupe")
+        detail.to_excel(writer, index=False, sheet_name="Detail_long")
+    return buffer.getvalue()
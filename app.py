@@ -1,9 +1,22 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
-import io
+import numpy as np
+import hashlib
 from datetime import datetime
 
+from analysis import (
+    build_export,
+    build_scatter,
+    build_top_figures,
+    build_total_line,
+    compute_parcours,
+    compute_resume_base,
+    extract_group,
+    load_excel,
+    monthly_totals,
+    period_dates,
+    prepare_long,
+)
+
 st.set_page_config(page_title="Analyse sous-groupe soins", layout="wide")
 
 st.title("📊 Analyse du sous-groupe « soins » – avec logique d’entrées, sorties et arrêts")
@@ -36,8 +49,10 @@ if uploaded_file is None:
     st.info("Dépose un fichier Excel pour commencer.")
     st.stop()
 
-# Lecture du fichier (1ère feuille)
-df_raw = pd.read_excel(uploaded_file)
+# Lecture du fichier (1ère feuille) : le parsing n'est refait qu'à chaque nouveau fichier
+file_bytes = uploaded_file.getvalue()
+file_hash = hashlib.sha1(file_bytes).hexdigest()
+df_raw = load_excel(file_bytes)
 
 st.subheader("👁‍🗨 Aperçu des données importées")
 st.dataframe(df_raw.head(), use_container_width=True)
@@ -60,26 +75,11 @@ if len(period_cols) == 0:
     st.error("Aucune colonne de mois détectée (en dehors de Salarie / Sous_groupe).")
     st.stop()
 
-# On crée une correspondance "nom de colonne" -> vraie date (en partant de janv-2024)
-# On suppose que les colonnes sont déjà dans l'ordre chronologique.
-dates = pd.date_range("2024-01-01", periods=len(period_cols), freq="MS")
-col_to_date = dict(zip(period_cols, dates))
-
-# Passage au format long
-df_long = df_raw.melt(
-    id_vars=id_cols,
-    value_vars=period_cols,
-    var_name="Periode_label",
-    value_name="Cout_global",
-)
-
-# Ajout de la date réelle
-df_long["Date"] = df_long["Periode_label"].map(col_to_date)
-df_long = df_long.dropna(subset=["Date"])  # au cas où
-df_long["Year"] = df_long["Date"].dt.year
+df_long = prepare_long(df_raw, file_hash, id_cols, period_cols)
 
-# On garde uniquement les lignes avec un coût renseigné
-df_long = df_long.dropna(subset=["Cout_global"])
+# Dates et libellés des mois, indexés par PerIdx
+dates = period_dates(len(period_cols))
+period_labels = np.asarray(period_cols, dtype=object)
 
 # --------------------------------------------------------
 # 2bis. CHOIX DU SOUS-GROUPE
@@ -89,7 +89,7 @@ group_options = sorted(df_long["Sous_groupe"].dropna().unique().tolist())
 default_idx = group_options.index("soins") if "soins" in group_options else 0
 selected_group = st.selectbox("Sous-groupe :", group_options, index=default_idx)
 
-df_group = df_long[df_long["Sous_groupe"] == selected_group].copy()
+df_group = extract_group(df_long, file_hash, selected_group)
 
 if df_group.empty:
     st.warning(f"Aucune donnée pour le sous-groupe « {selected_group} ».")
@@ -110,110 +110,13 @@ seuil_absence = st.slider(
     help="En-dessous de ce montant, on considère que le salarié n'est que très peu présent (arrêt, congé long, temps partiel très réduit...).",
 )
 
-# Index temporel global
-dates_sorted = sorted(df_group["Date"].unique())
-date_to_idx = {d: i for i, d in enumerate(dates_sorted)}
-df_group["idx"] = df_group["Date"].map(date_to_idx)
-
-global_first_idx = 0
-global_last_idx = len(dates_sorted) - 1
-
-def longest_true_streak(bool_list):
-    """Retourne la longueur max de 'True' consécutifs dans une liste booléenne."""
-    max_streak = 0
-    streak = 0
-    for val in bool_list:
-        if val:
-            streak += 1
-            max_streak = max(max_streak, streak)
-        else:
-            streak = 0
-    return max_streak
-
-def parcours_logic(sub):
-    """Calcule la logique entrée/sortie/arrêts pour un salarié."""
-    sub = sub.sort_values("idx")
-    first_idx = int(sub["idx"].min())
-    last_idx = int(sub["idx"].max())
-
-    entree = first_idx > global_first_idx
-    sortie = last_idx < global_last_idx
-
-    faible = (sub["Cout_global"] <= seuil_absence) | sub["Cout_global"].isna()
-    nb_faibles = int(faible.sum())
-    longest = int(longest_true_streak(list(faible)))
-
-    return pd.Series({
-        "entree_en_cours": entree,
-        "sortie_en_cours": sortie,
-        "nb_mois_faibles": nb_faibles,
-        "plus_long_arret": longest,
-    })
-
-parcours = (
-    df_group.groupby("Salarie")
-    .apply(parcours_logic)
-    .reset_index()
-)
+parcours = compute_parcours(df_group, file_hash, selected_group, seuil_absence)
 
 # --------------------------------------------------------
 # 3. INDICATEURS PAR SALARIÉ
 # --------------------------------------------------------
 
-# Moyenne annuelle par salarié
-annual_mean = (
-    df_group
-    .groupby(["Salarie", "Sous_groupe", "Year"], as_index=False)["Cout_global"]
-    .mean()
-)
-
-# Pivot pour avoir 2024 / 2025 côte à côte
-resume = annual_mean.pivot_table(
-    index=["Salarie", "Sous_groupe"],
-    columns="Year",
-    values="Cout_global"
-).reset_index()
-
-# Renommage plus lisible
-col_2024 = 2024 if 2024 in resume.columns else None
-col_2025 = 2025 if 2025 in resume.columns else None
-
-if col_2024 is not None:
-    resume["moy_2024"] = resume[col_2024]
-else:
-    resume["moy_2024"] = pd.NA
-
-if col_2025 is not None:
-    resume["moy_2025"] = resume[col_2025]
-else:
-    resume["moy_2025"] = pd.NA
-
-# Variation absolue / relative
-resume["var_abs"] = resume["moy_2025"] - resume["moy_2024"]
-resume["var_rel_%"] = resume["var_abs"] / resume["moy_2024"] * 100
-
-# Volatilité (écart-type)
-volatility = (
-    df_group
-    .groupby("Salarie")["Cout_global"]
-    .std()
-    .rename("ecart_type")
-    .reset_index()
-)
-
-resume = resume.merge(volatility, on="Salarie", how="left")
-
-# Anomalies (valeurs très faibles ou négatives)
-df_group["Anomalie"] = (df_group["Cout_global"] <= 0) | (df_group["Cout_global"] < 500)
-anom_summary = (
-    df_group.groupby("Salarie")["Anomalie"]
-    .sum()
-    .rename("nb_anomalies")
-    .reset_index()
-)
-
-resume = resume.merge(anom_summary, on="Salarie", how="left")
-resume["nb_anomalies"] = resume["nb_anomalies"].fillna(0).astype(int)
+resume = compute_resume_base(df_group, file_hash, selected_group)
 
 # Ajout de la logique de parcours (entrées, sorties, arrêts)
 resume = resume.merge(parcours, on="Salarie", how="left")
@@ -255,24 +158,9 @@ st.markdown(
 
 # Graphique global : évolution mensuelle totale du sous-groupe
 st.markdown("### 📉 Évolution mensuelle globale du sous-groupe")
-agg_month = (
-    df_group.groupby("Date", as_index=False)["Cout_global"]
-    .sum()
-    .sort_values("Date")
-)
+agg_month = monthly_totals(df_group, dates)
 
-fig_tot = px.line(
-    agg_month,
-    x="Date",
-    y="Cout_global",
-    markers=True,
-    title=f"Coût global mensuel du sous-groupe « {selected_group} »",
-)
-fig_tot.update_layout(
-    xaxis_title="Mois",
-    yaxis_title="Coût global (€)",
-    xaxis_tickformat="%m/%Y",
-)
+fig_tot = build_total_line(agg_month, selected_group)
 st.plotly_chart(fig_tot, use_container_width=True)
 
 # --------------------------------------------------------
@@ -283,55 +171,16 @@ st.subheader("🏆 Salariés qui expliquent les principales évolutions")
 
 top_n = st.slider("Nombre de salariés à afficher dans les classements :", 5, 20, 10)
 
-# Top hausses
-top_up = resume_sorted.head(top_n)
-# Top baisses
-top_down = resume_sorted.sort_values("var_abs", ascending=True).head(top_n)
+fig_up, fig_down = build_top_figures(resume_sorted, top_n)
 
 col_up, col_down = st.columns(2)
 
 with col_up:
     st.markdown("#### 📈 Plus fortes **hausses** (moyenne 2025 vs 2024)")
-    fig_up = px.bar(
-        top_up,
-        x="Salarie",
-        y="var_abs",
-        hover_data=[
-            "moy_2024",
-            "moy_2025",
-            "var_rel_%",
-            "ecart_type",
-            "nb_anomalies",
-            "entree_en_cours",
-            "sortie_en_cours",
-            "plus_long_arret",
-        ],
-        title="Top hausses de coût moyen annuel",
-    )
-    fig_up.update_layout(xaxis_title="", yaxis_title="Variation absolue (€)")
-    fig_up.update_xaxes(tickangle=45)
     st.plotly_chart(fig_up, use_container_width=True)
 
 with col_down:
     st.markdown("#### 📉 Plus fortes **baisses**")
-    fig_down = px.bar(
-        top_down,
-        x="Salarie",
-        y="var_abs",
-        hover_data=[
-            "moy_2024",
-            "moy_2025",
-            "var_rel_%",
-            "ecart_type",
-            "nb_anomalies",
-            "entree_en_cours",
-            "sortie_en_cours",
-            "plus_long_arret",
-        ],
-        title="Top baisses de coût moyen annuel",
-    )
-    fig_down.update_layout(xaxis_title="", yaxis_title="Variation absolue (€)")
-    fig_down.update_xaxes(tickangle=45)
     st.plotly_chart(fig_down, use_container_width=True)
 
 # --------------------------------------------------------
@@ -340,35 +189,12 @@ with col_down:
 
 st.subheader("🌪 Stabilité vs niveau de coût (en tenant compte des arrêts)")
 
-df_scatter = resume.dropna(subset=["moy_2024", "ecart_type", "var_abs"]).copy()
+df_scatter = resume.dropna(subset=["moy_2024", "ecart_type", "var_abs"])
 
 if df_scatter.empty:
     st.info("Pas assez de données complètes pour afficher le graphique de stabilité.")
 else:
-    df_scatter["size_var"] = df_scatter["var_abs"].abs()
-
-    fig_scatter = px.scatter(
-        df_scatter,
-        x="moy_2024",
-        y="ecart_type",
-        size="size_var",
-        color="var_abs",
-        hover_data=[
-            "Salarie",
-            "moy_2025",
-            "var_rel_%",
-            "nb_anomalies",
-            "entree_en_cours",
-            "sortie_en_cours",
-            "plus_long_arret",
-            "nb_mois_faibles",
-        ],
-        title="Niveau moyen 2024 vs volatilité (variation en taille/couleur, arrêts en info-bulle)",
-    )
-    fig_scatter.update_layout(
-        xaxis_title="Coût moyen 2024 (€)",
-        yaxis_title="Écart-type du coût mensuel (€)",
-    )
+    fig_scatter = build_scatter(df_scatter)
     st.plotly_chart(fig_scatter, use_container_width=True)
 
     st.markdown(
@@ -389,7 +215,8 @@ else:
 
 st.subheader("⚠️ Anomalies possibles (très faible ou négatif)")
 
-df_anom = df_group[df_group["Anomalie"]].copy()
+# Masque déjà calculé dans extract_group : simple sélection positionnelle
+df_anom = df_group.iloc[df_group["Anomalie"].to_numpy()]
 if df_anom.empty:
     st.info("Aucune anomalie nette détectée (coût < 500 € ou ≤ 0).")
 else:
@@ -399,10 +226,9 @@ Les lignes ci-dessous correspondent à des **coûts mensuels très faibles ou n
 (qui peuvent être soit des **erreurs de données**, soit des cas particuliers à vérifier : régularisations, fins de contrat, etc.).
 """
     )
+    df_anom = df_anom.assign(Periode_label=period_labels[df_anom["PerIdx"].to_numpy()])
     st.dataframe(
-        df_anom.sort_values(["Salarie", "Date"])[
-            ["Salarie", "Date", "Cout_global", "Periode_label"]
-        ],
+        df_anom[["Salarie", "Date", "Cout_global", "Periode_label"]],
         use_container_width=True,
     )
 
@@ -441,7 +267,8 @@ if delta_total != 0:
 else:
     part_top = 0
 
-sal_instable = resume_sorted.sort_values("ecart_type", ascending=False).iloc[0]
+# Écart-type toujours ≥ 0 : fillna(-1) place les salariés sans écart-type en dernier, comme un tri
+sal_instable = resume.loc[resume["ecart_type"].fillna(-1).idxmax()]
 
 st.markdown(
     f"""
@@ -454,15 +281,11 @@ st.markdown(
 """
 )
 
-# Export Excel
-buffer = io.BytesIO()
-with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-    resume_sorted.to_excel(writer, index=False, sheet_name="Resume_sous_groupe")
-    df_group.to_excel(writer, index=False, sheet_name="Detail_long")
-
-st.download_button(
-    "💾 Télécharger le fichier d'analyse (Excel)",
-    data=buffer.getvalue(),
-    file_name=f"analyse_{selected_group}.xlsx",
-    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-)
+# Export Excel : généré uniquement à la demande (et mis en cache), pas à chaque rerun
+if st.button("📦 Préparer le fichier d'analyse (Excel)"):
+    st.download_button(
+        "💾 Télécharger le fichier d'analyse (Excel)",
+        data=build_export(resume_sorted, df_group, period_labels, file_hash, selected_group, seuil_absence),
+        file_name=f"analyse_{selected_group}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )